@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""Benchmark concurrent connections on the Flask server and the async server (mock backend)
+
+Every client opens its own connection and posts to /api/generate while a probe
+measures /voices latency. The server's peak thread count and memory show what
+each open connection costs.
+
+Usage: python benchmarks/concurrent_connections.py [--connections 50 200 500]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Concurrent connection benchmark on the mock TTS backend')
+    parser.add_argument('--connections', type=int, nargs='+', default=[50, 200, 500], help='Concurrent connections to open')
+    parser.add_argument('--servers', nargs='+', default=['flask', 'async'], choices=['flask', 'async'], help='Servers to measure')
+    parser.add_argument('--seconds-per-char', type=float, default=0.0005, help='Simulated mock inference time per character')
+    parser.add_argument('--text', default='Hello from the benchmark.', help='Text to synthesize')
+    parser.add_argument('--port', type=int, default=9181, help='Port to run the servers on')
+    parser.add_argument('--timeout', type=float, default=300, help='Timeout of a single request in seconds')
+    return parser.parse_args()
+
+async def http_request(port, method, path, body=b''):
+    """Send one request on a new connection and return (status, body)"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        head = (f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n")
+        writer.write(head.encode() + body)
+        await writer.drain()
+        data = await reader.read()
+    finally:
+        writer.close()
+    head, _, payload = data.partition(b'\r\n\r\n')
+    return int(head.split(b' ', 2)[1]), payload
+
+def process_stats(pid):
+    """Return the thread count and resident memory (MB) of a process"""
+    threads = rss = 0
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('Threads:'):
+                threads = int(line.split()[1])
+            elif line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) / 1024
+    return threads, rss
+
+async def wait_ready(port, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            status, _ = await http_request(port, 'GET', '/voices')
+            if status == 200:
+                return
+        except OSError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+async def run_load(args, pid, connections):
+    body = json.dumps({'text': args.text, 'voice': 'Carter'}).encode()
+    done = asyncio.Event()
+    probe_latencies = []
+    peak = [0, 0]
+
+    async def client():
+        try:
+            status, payload = await asyncio.wait_for(http_request(args.port, 'POST', '/api/generate', body), args.timeout)
+            return status == 200 and json.loads(payload).get('success', False)
+        except (OSError, ValueError, asyncio.TimeoutError):
+            return False
+
+    async def probe():
+        while not done.is_set():
+            start = time.perf_counter()
+            try:
+                await http_request(args.port, 'GET', '/voices')
+                probe_latencies.append((time.perf_counter() - start) * 1000)
+            except OSError:
+                pass
+            await asyncio.sleep(0.1)
+
+    async def monitor():
+        while not done.is_set():
+            threads, rss = process_stats(pid)
+            peak[0] = max(peak[0], threads)
+            peak[1] = max(peak[1], rss)
+            await asyncio.sleep(0.05)
+
+    tasks = [asyncio.create_task(probe()), asyncio.create_task(monitor())]
+    start = time.perf_counter()
+    results = await asyncio.gather(*[client() for _ in range(connections)])
+    wall = time.perf_counter() - start
+    done.set()
+    await asyncio.gather(*tasks)
+
+    ok = sum(results)
+    return {
+        'ok': ok,
+        'failed': connections - ok,
+        'wall': wall,
+        'voices_p50': statistics.median(probe_latencies) if probe_latencies else float('nan'),
+        'voices_max': max(probe_latencies) if probe_latencies else float('nan'),
+        'threads': peak[0],
+        'rss': peak[1],
+    }
+
+def main():
+    args = parse_args()
+    rows = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        env = dict(os.environ, MOCK_TTS='yes', OUTPUT_DIR=output_dir,
+                   MOCK_TTS_SECONDS_PER_CHAR=str(args.seconds_per_char))
+        for server in args.servers:
+            command = [sys.executable, '-m', 'src.main', '--host', '127.0.0.1',
+                       '--port', str(args.port), '--skip-setup']
+            if server == 'async':
+                command.append('--async')
+            process = subprocess.Popen(command, cwd=PROJECT_ROOT, env=env,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                asyncio.run(wait_ready(args.port))
+                for connections in args.connections:
+                    result = asyncio.run(run_load(args, process.pid, connections))
+                    rows.append((server, connections, result))
+            finally:
+                process.terminate()
+                process.wait()
+
+    print(f"{'server':>6} {'conns':>6} {'ok':>5} {'failed':>6} {'wall':>8} "
+          f"{'voices p50':>11} {'voices max':>11} {'threads':>8} {'rss MB':>7}")
+    for server, connections, r in rows:
+        print(f"{server:>6} {connections:>6} {r['ok']:>5} {r['failed']:>6} {r['wall']:>7.2f}s "
+              f"{r['voices_p50']:>9.1f}ms {r['voices_max']:>9.1f}ms {r['threads']:>8} {r['rss']:>7.0f}")
+
+if __name__ == "__main__":
+    main()
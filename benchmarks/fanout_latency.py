@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""Benchmark generate_fanout latency against segment count on the mock backend
+
+Only the fan-out itself is measured, on a pool with one replica per lane.
+The /api/generate endpoint, its shared replica pools and the FANOUT_MAX_PARALLEL
+default are not involved.
+
+Usage: python benchmarks/fanout_latency.py [--parallel 2 4 8] [--segments 1 2 4 8 16]
+"""
+import argparse
+import os
+import sys
+import time
+
+# Add the project root to the Python path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Fan-out latency benchmark on the mock TTS backend')
+    parser.add_argument('--segments', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='Segment counts to measure')
+    parser.add_argument('--parallel', type=int, nargs='+', default=[2, 4, 8], help='Per-request parallelism to measure')
+    parser.add_argument('--seconds-per-char', type=float, default=0.002, help='Simulated mock inference time per character')
+    parser.add_argument('--sentence-chars', type=int, default=200, help='Length of each sentence (one segment each)')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs per measurement, the best is reported')
+    return parser.parse_args()
+
+def best_of(repeats, fn):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main():
+    args = parse_args()
+    max_parallel = max(args.parallel)
+
+    # Configure the mock and fan-out modules before they read their settings
+    os.environ['MOCK_TTS_SECONDS_PER_CHAR'] = str(args.seconds_per_char)
+    os.environ['FANOUT_MAX_PARALLEL'] = str(max_parallel)
+    os.environ['FANOUT_WORKERS'] = str(max_parallel)
+    from src.mock_tts import MockChatterboxTTS
+    from src.fanout import ReplicaPool, generate_fanout, split_segments
+
+    sentence = ("word " * (args.sentence_chars // 5)).strip()[:args.sentence_chars - 1] + "."
+    pool = ReplicaPool(MockChatterboxTTS.from_pretrained, max_parallel)
+    model = MockChatterboxTTS.from_pretrained()
+
+    def synthesize(replica, segment):
+        return replica.generate(segment, audio_prompt_path="en-Carter_man.wav")
+
+    # Silence the per-call logging of the mock backend while measuring
+    results = []
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for n in args.segments:
+            text = " ".join([sentence] * n)
+            segments = split_segments(text, max_chars=args.sentence_chars)
+            row = [n, best_of(args.repeats, lambda: synthesize(model, text))]
+            for parallel in args.parallel:
+                row.append(best_of(args.repeats, lambda: generate_fanout(segments, pool, parallel, synthesize)))
+            results.append(row)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    header = f"{'segments':>8} {'sequential':>11}" + "".join(f" {'parallel=' + str(p):>12}" for p in args.parallel)
+    print(header)
+    for n, sequential, *fanout in results:
+        line = f"{n:>8} {sequential:>10.3f}s" + "".join(f" {t:>11.3f}s" for t in fanout)
+        print(line)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+
+from . import http_server
+from . import packs
+from . import profiling
+from .common import VoiceMapper
+from .router import HOP_HEADERS
+
+# Configuration
+# Size of the executor running model inference; connections never hold one of its threads while idle
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', 1))
+KEEPALIVE_TIMEOUT = float(os.environ.get('KEEPALIVE_TIMEOUT', 75))
+# How long shutdown waits for in-flight generations to finish
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', 300))
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), 'templates', 'index.html')
+
+INFERENCE_EXECUTOR = web.AppKey('inference_executor', ThreadPoolExecutor)
+SHUTTING_DOWN = web.AppKey('shutting_down', asyncio.Event)
+
+
+def _dispatch_to_flask(method, path, query_string, headers, body, base_url, environ_base):
+    """Run a request through the Flask app and return (status, headers, body)"""
+    app = http_server.app
+    with app.test_request_context(path, method=method, query_string=query_string, headers=headers,
+                                  data=body, base_url=base_url, environ_base=environ_base):
+        response = app.full_dispatch_request()
+        try:
+            data = b''.join(response.iter_encoded())
+        finally:
+            response.close()
+        return response.status_code, list(response.headers.items()), data
+
+
+async def _forward(request, executor=None):
+    """Forward a request to the Flask app on the given executor (the default I/O executor if None)"""
+    body = await request.read()
+    headers = [(k, v) for k, v in request.headers.items() if k.lower() not in HOP_HEADERS]
+    environ_base = {'REMOTE_ADDR': request.remote or ''}
+    loop = asyncio.get_running_loop()
+    status, response_headers, data = await loop.run_in_executor(
+        executor, _dispatch_to_flask, request.method, request.path, request.query_string,
+        headers, body, f"{request.scheme}://{request.host}", environ_base
+    )
+    response = web.Response(status=status, body=data)
+    for key, value in response_headers:
+        if key.lower() not in HOP_HEADERS:
+            response.headers.add(key, value)
+    return response
+
+
+def _prepare(params, api):
+    """Resolve the voice and look up prompt packs, returning (voice_path, lang, response)
+
+    response is set when the request is answered without the model.
+    """
+    log_prefix = 'API: ' if api else ''
+    try:
+        voice_path, lang = http_server.resolve_voice(params['voice'], log_prefix=log_prefix)
+    except LookupError as e:
+        return None, None, http_server.error_response(str(e), api)
+    http_server.note_voice_used(voice_path)
+    if api:
+        # Prompt pack hits are answered without the model
+        return voice_path, lang, http_server.pack_response(params, voice_path)
+    return voice_path, lang, None
+
+
+def _render(params, voice_path, lang, api, profile_mode, endpoint):
+    """Run the model part of a generation on the inference executor, returning (response, profile id)"""
+    log_prefix = 'API: ' if api else ''
+    try:
+        if profile_mode is None:
+            return http_server.render_audio(params, voice_path, lang, log_prefix), None
+        return profiling.run_profiled(profile_mode, endpoint, http_server.render_audio,
+                                      params, voice_path, lang, log_prefix)
+    except Exception as e:
+        traceback.print_exc()
+        return http_server.error_response(str(e), api=False), None
+
+
+async def generate(request):
+    """Handle /generate and /api/generate, running only model work on the inference executor
+
+    Parsing, validation, voice resolution and prompt pack hits don't wait for
+    the inference executor.
+    """
+    if request.method != 'POST':
+        # CORS preflight requests and 405s are answered by the Flask app
+        return await _forward(request)
+    if request.app[SHUTTING_DOWN].is_set():
+        return web.json_response({
+            'success': False,
+            'error_message': 'Server is shutting down',
+            'audio_url': ''
+        }, status=503)
+
+    api = request.path == '/api/generate'
+    try:
+        if api:
+            try:
+                data = await request.json()
+            except ValueError:
+                data = None
+        else:
+            data = await request.post()
+        params, error = http_server.parse_generate_params(data, api=api)
+    except (ValueError, TypeError, AttributeError) as e:
+        params, error = None, http_server.error_response(str(e), api=False)
+    if error:
+        return web.json_response(error)
+
+    loop = asyncio.get_running_loop()
+    profile_id = None
+    # Counted from the time it is accepted, so that /status reports the load waiting on the executor
+    with http_server.generation_in_flight():
+        voice_path, lang, response = await loop.run_in_executor(None, _prepare, params, api)
+        if response is None:
+            response, profile_id = await loop.run_in_executor(
+                request.app[INFERENCE_EXECUTOR], _render, params, voice_path, lang, api,
+                profiling.requested_mode(request.headers), request.path
+            )
+    headers = {profiling.PROFILE_ID_HEADER: profile_id} if profile_id else None
+    return web.json_response(response, headers=headers)
+
+
+async def forward(request):
+    """Forward routes that only do light I/O, such as the profile admin endpoints"""
+    return await _forward(request)
+
+
+async def get_status(request):
+    """Forward /status, reporting the server as unavailable while it drains"""
+    if request.app[SHUTTING_DOWN].is_set():
+        return web.json_response({'error_message': 'Server is shutting down'}, status=503)
+    return await _forward(request)
+
+
+async def index(request):
+    return web.FileResponse(TEMPLATE_PATH)
+
+
+async def get_voices(request):
+    """Get available voices, with the same JSON as the Flask /voices route"""
+    # Reload the mapper to pick up new voices, as the Flask route does
+    loop = asyncio.get_running_loop()
+    http_server.voice_mapper = await loop.run_in_executor(None, VoiceMapper)
+
+    voices = []
+    for name, (_, lang_code) in http_server.voice_mapper.voice_presets.items():
+        display_name = name
+        if lang_code:
+            display_name = f"{lang_code.upper()} - {name}"
+        voices.append({
+            'name': name,
+            'display_name': display_name,
+            'lang': lang_code or 'en'
+        })
+
+    # If no voices were found, add a default voice
+    if not voices:
+        voices.append({
+            'name': 'default',
+            'display_name': 'Default Voice',
+            'lang': 'en'
+        })
+    return web.json_response(voices)
+
+
+async def serve_audio(request):
+    """Serve generated audio files"""
+    filename = request.match_info['filename']
+    if filename.startswith(packs.AUDIO_PREFIX):
+        # Send the slice of the memory-mapped pack without copying it
+        audio = packs.audio_slice(filename)
+        if audio is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=audio, content_type='audio/wav')
+    path = os.path.join(http_server.OUTPUT_DIR, filename)
+    if filename != os.path.basename(filename) or filename.startswith('.') or not os.path.isfile(path):
+        raise web.HTTPNotFound()
+    return web.FileResponse(path)
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    response = await handler(request)
+    response.headers.setdefault('Access-Control-Allow-Origin', '*')
+    return response
+
+
+async def on_shutdown(app):
+    # Refuse new generations on kept-alive connections while in-flight ones drain
+    app[SHUTTING_DOWN].set()
+    print("Shutting down, waiting for in-flight generations to finish")
+
+
+async def on_cleanup(app):
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, app[INFERENCE_EXECUTOR].shutdown, True)
+    print("Inference executor stopped")
+
+
+def create_app():
+    """Create the async app serving the same routes as the Flask app"""
+    app = web.Application(middlewares=[cors_middleware])
+    app[INFERENCE_EXECUTOR] = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix='inference')
+    app[SHUTTING_DOWN] = asyncio.Event()
+    app.router.add_get('/', index)
+    app.router.add_get('/voices', get_voices)
+    app.router.add_get('/audio/{filename}', serve_audio)
+    app.router.add_get('/status', get_status)
+    # '*' so that CORS preflight requests reach flask-cors as well
+    app.router.add_route('*', '/generate', generate)
+    app.router.add_route('*', '/api/generate', generate)
+    app.router.add_route('*', '/admin/profiles', forward)
+    app.router.add_route('*', '/admin/profiles/{profile_id}', forward)
+    app.on_shutdown.append(on_shutdown)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def run_async_server(host='0.0.0.0', port=9080, debug=False):
+    """Run the async server"""
+    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
+    print(f"Inference workers: {INFERENCE_WORKERS}")
+    web.run_app(create_app(), host=host, port=port,
+                keepalive_timeout=KEEPALIVE_TIMEOUT, shutdown_timeout=SHUTDOWN_TIMEOUT)
@@ -1,5 +1,6 @@
 from transformers.utils import logging
 import os
+from .setup_voices import load_manifest
 
 logging.set_verbosity_info()
 logger = logging.get_logger(__name__)
@@ -27,7 +28,7 @@ class VoiceMapper:
         print(f"Voice presets: {self.voice_presets}")
 
     def setup_voice_presets(self):
-        """Setup voice presets by scanning the voices directory."""
+        """Setup voice presets from the voice manifest, scanning the voices directory if there is none."""
         voices_dir = os.path.join(os.path.dirname(__file__), "voices")
         
         # Check if voices directory exists
@@ -37,8 +38,33 @@ class VoiceMapper:
             self.available_voices = {}
             return
         
-        # Scan for all WAV files in the voices directory
-        self.voice_presets = {}
+        manifest = load_manifest(voices_dir)
+        if manifest is not None:
+            # Use the pre-processed prompts written by setup_voices
+            self.voice_presets = {
+                name: os.path.join(voices_dir, entry['prompt'])
+                for name, entry in manifest['voices'].items()
+            }
+        else:
+            print(f"No voice manifest found in {voices_dir}, scanning for voice files")
+            self.voice_presets = self.scan_voices_dir(voices_dir)
+        
+        # Sort the voice presets alphabetically by name for better UI
+        self.voice_presets = dict(sorted(self.voice_presets.items()))
+        
+        # Filter out voices that don't exist (e.g. removed since the manifest was written)
+        self.available_voices = {
+            name: path for name, path in self.voice_presets.items()
+            if os.path.exists(path)
+        }
+        self.voice_presets = self.available_voices
+        
+        print(f"Found {len(self.available_voices)} voice files in {voices_dir}")
+        print(f"Available voices: {', '.join(self.available_voices.keys())}")
+
+    def scan_voices_dir(self, voices_dir):
+        """Map the name of every WAV file in the voices directory to its path."""
+        voice_presets = {}
         
         # Get all .wav files in the voices directory
         wav_files = [f for f in os.listdir(voices_dir) 
@@ -50,19 +76,9 @@ class VoiceMapper:
             name = os.path.splitext(wav_file)[0]
             # Create full path
             full_path = os.path.join(voices_dir, wav_file)
-            self.voice_presets[name] = full_path
-        
-        # Sort the voice presets alphabetically by name for better UI
-        self.voice_presets = dict(sorted(self.voice_presets.items()))
+            voice_presets[name] = full_path
         
-        # Filter out voices that don't exist (this is now redundant but kept for safety)
-        self.available_voices = {
-            name: path for name, path in self.voice_presets.items()
-            if os.path.exists(path)
-        }
-        
-        print(f"Found {len(self.available_voices)} voice files in {voices_dir}")
-        print(f"Available voices: {', '.join(self.available_voices.keys())}")
+        return voice_presets
 
     def get_voice_path_and_lang(self, speaker_name: str) -> (str, str):
         """Get voice file path for a given speaker name"""
@@ -0,0 +1,171 @@
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import torch
+
+# Configuration
+# Model replicas loaded per (device, language), shared by all requests
+FANOUT_REPLICAS = int(os.environ.get('FANOUT_REPLICAS', 2))
+# Maximum number of segments a single request may synthesize at once, by default
+# half the replicas so that one request can't take the whole pool
+FANOUT_MAX_PARALLEL = int(os.environ.get('FANOUT_MAX_PARALLEL', max(1, FANOUT_REPLICAS // 2)))
+# Threads shared by all fan-out requests
+FANOUT_WORKERS = int(os.environ.get('FANOUT_WORKERS', 4))
+# Sentences are grouped into segments of up to this many characters
+FANOUT_SEGMENT_CHARS = int(os.environ.get('FANOUT_SEGMENT_CHARS', 300))
+FANOUT_PAUSE_SECONDS = float(os.environ.get('FANOUT_PAUSE_SECONDS', 0.15))
+FANOUT_FADE_SECONDS = float(os.environ.get('FANOUT_FADE_SECONDS', 0.01))
+
+# Latin punctuation ends a sentence only when followed by whitespace, CJK punctuation always does
+_CJK_SENTENCE_ENDS = '。！？；'
+_SENTENCE_END_RE = re.compile(r'(?<=[.!?;])\s+|(?<=[' + _CJK_SENTENCE_ENDS + r'])\s*')
+
+_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='fanout')
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ReplicaPool:
+    """Fixed-size pool of model replicas, each used by one generation at a time"""
+
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.size = size
+        self.created = 0
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self):
+        """Borrow a replica, loading a new one if the pool is not full yet"""
+        replica = self.get()
+        try:
+            yield replica
+        finally:
+            self.put(replica)
+
+    def put(self, replica):
+        """Return a replica taken with get()"""
+        self.idle.put(replica)
+
+    def get(self):
+        """Take a replica, waiting for one if all are loaded and busy"""
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            return self.idle.get()
+
+        print(f"Loading model replica {self.created}/{self.size}")
+        try:
+            return self.factory()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+
+def get_replica_pool(key, factory):
+    """Get or create the replica pool for a model key"""
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ReplicaPool(factory, FANOUT_REPLICAS)
+        return _pools[key]
+
+
+def loaded_pool_keys():
+    """Return the keys of the replica pools that have loaded at least one replica"""
+    with _pools_lock:
+        return [key for key, pool in _pools.items() if pool.created > 0]
+
+
+def split_segments(text, max_chars=None):
+    """Split text at sentence boundaries into segments of up to max_chars characters
+
+    Sentences longer than max_chars are kept whole.
+    """
+    max_chars = max_chars or FANOUT_SEGMENT_CHARS
+    sentences = [s.strip() for s in _SENTENCE_END_RE.split(text) if s.strip()]
+
+    segments = []
+    current = ''
+    for sentence in sentences:
+        # CJK text has no spaces between sentences, so none are inserted
+        separator = '' if current.endswith(tuple(_CJK_SENTENCE_ENDS)) else ' '
+        if current and len(current) + len(separator) + len(sentence) > max_chars:
+            segments.append(current)
+            current = sentence
+        else:
+            current = f"{current}{separator}{sentence}" if current else sentence
+    if current:
+        segments.append(current)
+    return segments
+
+
+def join_segments(wavs, sr):
+    """Concatenate segment waveforms with short fades and a pause between them"""
+    fade = int(sr * FANOUT_FADE_SECONDS)
+    parts = []
+    for i, wav in enumerate(wavs):
+        wav = wav.clone()
+        n = min(fade, wav.shape[-1] // 2)
+        if n > 0:
+            ramp = torch.linspace(0, 1, n, dtype=wav.dtype)
+            if i > 0:
+                wav[..., :n] *= ramp
+            if i < len(wavs) - 1:
+                wav[..., -n:] *= ramp.flip(0)
+        if i > 0:
+            parts.append(torch.zeros(*wav.shape[:-1], int(sr * FANOUT_PAUSE_SECONDS), dtype=wav.dtype))
+        parts.append(wav)
+    return torch.cat(parts, dim=-1)
+
+
+def generate_fanout(segments, pool, parallel, synthesize):
+    """Synthesize segments from split_segments in parallel and join them in order
+
+    synthesize(model, segment) must return a waveform tensor of shape (1, n).
+    At most `parallel` segments (capped by FANOUT_MAX_PARALLEL) are in flight.
+    Returns the joined waveform and its sample rate.
+    """
+    if not segments:
+        raise ValueError("Text contains no segments to synthesize")
+    parallel = max(1, min(parallel, FANOUT_MAX_PARALLEL, len(segments)))
+    print(f"Fan-out: {len(segments)} segments, parallelism {parallel}")
+
+    results = [None] * len(segments)
+    pending = queue.Queue()
+    for i in range(len(segments)):
+        pending.put(i)
+    failed = threading.Event()
+
+    def lane():
+        # Each lane synthesizes segments one after another until none are left
+        while not failed.is_set():
+            try:
+                i = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                with pool.acquire() as model:
+                    wav = synthesize(model, segments[i])
+                    results[i] = (wav.detach().cpu(), model.sr)
+            except Exception:
+                failed.set()
+                raise
+
+    futures = [_executor.submit(lane) for _ in range(parallel)]
+    for future in futures:
+        future.result()
+
+    sr = results[0][1]
+    return join_segments([wav for wav, _ in results], sr), sr
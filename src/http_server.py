@@ -2,13 +2,19 @@ import os
 import json
 import uuid
 import tempfile
-from flask import Flask, render_template, request, jsonify, send_from_directory
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from flask import Flask, render_template, request, jsonify, send_from_directory, Response, abort
 from flask_cors import CORS
 import torch
 import torchaudio as ta
 
 # Try to import actual models, fall back to mock models if not available
 try:
+    if os.environ.get('MOCK_TTS') == "yes":
+        raise ImportError("MOCK_TTS is set")
     from chatterbox.tts import ChatterboxTTS
     from chatterbox.mtl_tts import ChatterboxMultilingualTTS
     USE_MOCK = False
@@ -20,6 +26,9 @@ except ImportError:
     USE_MOCK = True
 
 from .common import VoiceMapper
+from .profiling import PROFILE_ENABLED, phase, profiled, list_profiles, profile_file, folded_stacks
+from .fanout import FANOUT_MAX_PARALLEL, get_replica_pool, generate_fanout, loaded_pool_keys, split_segments
+from . import packs
 
 app = Flask(__name__)
 CORS(app)
@@ -31,19 +40,258 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 # Initialize voice mapper
 voice_mapper = VoiceMapper()
 
-# Initialize models dictionary to cache models
-models = {}
+# Generations in progress and recently used voices, reported by /status for the router
+STATUS_RECENT_VOICES = int(os.environ.get('STATUS_RECENT_VOICES', 16))
+in_flight = 0
+recent_voices = OrderedDict()
+status_lock = threading.Lock()
 
-def get_model(device="cpu", lang="en"):
-    """Get or initialize TTS model"""
-    key = f"{device}_{lang}"
-    if key not in models:
-        print(f"Initializing model for {lang} on {device}")
-        if lang == 'en':
-            models[key] = ChatterboxTTS.from_pretrained(device=device)
+def load_model(device="cpu", lang="en"):
+    """Load a new TTS model instance"""
+    print(f"Initializing model for {lang} on {device}")
+    if lang == 'en':
+        return ChatterboxTTS.from_pretrained(device=device)
+    return ChatterboxMultilingualTTS.from_pretrained(device=device)
+
+def get_model_pool(device="cpu", lang="en"):
+    """Get the pool of model replicas for a device and language
+
+    Generation changes a model's conditioning, so every generation borrows a
+    replica from the pool rather than sharing one model.
+    """
+    return get_replica_pool(f"{device}_{lang}", lambda: load_model(device=device, lang=lang))
+
+@contextmanager
+def borrowed_model(device="cpu", lang="en"):
+    """Borrow a model replica for one generation, loading it on first use"""
+    pool = get_model_pool(device=device, lang=lang)
+    with phase('model_acquisition'):
+        model = pool.get()
+    try:
+        yield model
+    finally:
+        pool.put(model)
+
+def synthesize(model, text, voice_path, cfg_scale, exaggeration, temperature, extra_args):
+    """Generate audio with a model, passing exaggeration and temperature if supported"""
+    if hasattr(model, 'generate_with_settings'):
+        return model.generate_with_settings(
+            text,
+            audio_prompt_path=voice_path,
+            cfg_weight=cfg_scale,
+            exaggeration=exaggeration,
+            temperature=temperature,
+            **extra_args
+        )
+    return model.generate(
+        text,
+        audio_prompt_path=voice_path,
+        cfg_weight=cfg_scale,
+        **extra_args
+    )
+
+@contextmanager
+def generation_in_flight():
+    """Count a generation in progress for /status"""
+    global in_flight
+    with status_lock:
+        in_flight += 1
+    try:
+        yield
+    finally:
+        with status_lock:
+            in_flight -= 1
+
+def tracked(view):
+    """Count the generations in progress for /status"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with generation_in_flight():
+            return view(*args, **kwargs)
+    return wrapper
+
+def voice_preset_name(voice_path):
+    """Get the name of the voice preset with the given file path"""
+    for name, value in voice_mapper.voice_presets.items():
+        if value[0] == voice_path:
+            return name
+    return os.path.splitext(os.path.basename(voice_path))[0]
+
+def note_voice_used(voice_path):
+    """Remember the voice preset behind voice_path as recently used"""
+    name = voice_preset_name(voice_path)
+    with status_lock:
+        recent_voices.pop(name, None)
+        recent_voices[name] = True
+        while len(recent_voices) > STATUS_RECENT_VOICES:
+            recent_voices.popitem(last=False)
+
+def error_response(message, api=True):
+    """Build the JSON of a failed generation; /generate also returns an empty audio_url"""
+    response = {'success': False, 'error_message': message}
+    if not api:
+        response['audio_url'] = ''
+    return response
+
+def parse_generate_params(data, api=True):
+    """Read and validate the parameters of a generation request
+
+    data is the /api/generate JSON body, or the /generate form if api is False.
+    Returns (params, error), where error is the JSON response for an invalid
+    request. Malformed numbers raise ValueError.
+    """
+    if api and not data:
+        return None, error_response('No JSON data provided')
+    params = {
+        'text': data.get('text', '').strip(),
+        'voice': data.get('voice', ''),
+        'cfg_scale': float(data.get('cfg', 0.4)),
+        'exaggeration': float(data.get('exaggeration', 0.3)),
+        'temperature': float(data.get('temperature', 0.5)),
+        'seed': int(data.get('seed', 0)),
+        'parallel': int(data.get('parallel', 0)) if api else 0,
+        'phrase_id': str(data.get('phrase_id', '')).strip() if api else '',
+    }
+    process = data.get('process', True) if api else data.get('process') == 'on'
+    
+    # Validate input
+    if not params['text'] and not params['phrase_id']:
+        return None, error_response('Text is required', api)
+    if not process:
+        return None, error_response('Processing is disabled', api)
+    return params, None
+
+def resolve_voice(voice_name, log_prefix=''):
+    """Get the voice path and language for a voice name, falling back to the first voice file
+
+    Raises LookupError if there is no voice to fall back to.
+    """
+    try:
+        result = voice_mapper.get_voice_path_and_lang(voice_name)
+    
+        # Handle different return types
+        if isinstance(result, tuple) and len(result) == 2:
+            voice_path, lang = result
+        elif isinstance(result, str):
+            voice_path = result
+            # Try to extract language from voice name
+            lang = None
+            if '-' in voice_name:
+                lang = voice_name.split('-')[0]
         else:
-            models[key] = ChatterboxMultilingualTTS.from_pretrained(device=device)
-    return models[key]
+            # Fallback
+            voice_path = str(result)
+            lang = None
+        
+        print(f"{log_prefix}Using voice: {os.path.basename(voice_path)}, Language: {lang or 'en'}")
+    except Exception as e:
+        # Fallback to first available voice file
+        print(f"{log_prefix}Error getting voice: {e}, falling back to default")
+        voices_dir = os.path.join(os.path.dirname(__file__), "voices")
+        if not os.path.exists(voices_dir):
+            raise LookupError('No voices directory found')
+        wav_files = [f for f in os.listdir(voices_dir) if f.endswith('.wav')]
+        if not wav_files:
+            raise LookupError('No voice files available')
+        voice_path = os.path.join(voices_dir, wav_files[0])
+        lang = None
+        if '-' in wav_files[0]:
+            lang = wav_files[0].split('-')[0]
+        print(f"{log_prefix}Fallback voice: {os.path.basename(voice_path)}, Language: {lang or 'en'}")
+    return voice_path, lang
+
+def pack_response(params, voice_path):
+    """Return the response for a phrase served from a prompt pack, or None if it must be generated"""
+    with phase('pack_lookup'):
+        pack_filename = packs.lookup(
+            voice_preset_name(voice_path), params['text'], params['phrase_id'],
+            {'cfg': params['cfg_scale'], 'exaggeration': params['exaggeration'], 'temperature': params['temperature']}
+        )
+    if pack_filename:
+        print(f"API: Serving {pack_filename} from prompt pack")
+        return {
+            'success': True,
+            'error_message': '',
+            'audio_url': f'/audio/{pack_filename}'
+        }
+    if not params['text']:
+        return error_response(f"Phrase not found in prompt packs: {params['phrase_id']}")
+    return None
+
+def render_audio(params, voice_path, lang, log_prefix=''):
+    """Generate the audio of a validated request with a borrowed model and save it to OUTPUT_DIR
+
+    This is the only part of a request that needs a model, and the part the
+    async server runs on its inference executor. Returns the JSON response.
+    """
+    text = params['text']
+    cfg_scale = params['cfg_scale']
+    exaggeration = params['exaggeration']
+    temperature = params['temperature']
+    seed = params['seed']
+    
+    # Set device
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if torch.backends.mps.is_available():
+        device = "mps"
+    
+    print(f"{log_prefix}Using device: {device}")
+    
+    # Fan out only when the text splits into more than one segment
+    parallel = min(params['parallel'], FANOUT_MAX_PARALLEL)
+    segments = split_segments(text) if parallel > 1 else []
+    fan_out = len(segments) > 1
+    
+    # Generate audio
+    print(f"{log_prefix}Generating audio with cfg_scale={cfg_scale}, exaggeration={exaggeration}, temperature={temperature}, parallel={parallel}")
+    
+    extra_args = {}
+    if lang and lang != 'en':
+        extra_args['language_id'] = lang
+    
+    if fan_out:
+        # Set seed if provided
+        if seed > 0:
+            torch.manual_seed(seed)
+        
+        # Segments borrow replicas from the pool as they are synthesized
+        with phase('generation'):
+            wav, sample_rate = generate_fanout(
+                segments,
+                get_model_pool(device=device, lang=lang or 'en'),
+                parallel,
+                lambda replica, segment: synthesize(
+                    replica, segment, voice_path, cfg_scale, exaggeration, temperature, extra_args
+                )
+            )
+    else:
+        # Borrow a model replica for the generation
+        with borrowed_model(device=device, lang=lang or 'en') as model:
+            sample_rate = model.sr
+            
+            # Set seed if provided
+            if seed > 0:
+                torch.manual_seed(seed)
+            
+            # Add exaggeration and temperature parameters if supported
+            with phase('generation'):
+                wav = synthesize(model, text, voice_path, cfg_scale, exaggeration, temperature, extra_args)
+    
+    # Generate unique filename
+    filename = f"output_{uuid.uuid4().hex[:8]}.wav"
+    output_path = os.path.join(OUTPUT_DIR, filename)
+    
+    # Save audio file
+    with phase('save'):
+        ta.save(output_path, wav, sample_rate)
+        print(f"{log_prefix}Saved output to {output_path}")
+    
+    # Return success response with audio URL
+    return {
+        'success': True,
+        'error_message': '',
+        'audio_url': f'/audio/{filename}'
+    }
 
 @app.route('/')
 def index():
@@ -147,131 +395,25 @@ def get_voices():
     return jsonify(voices)
 
 @app.route('/generate', methods=['POST'])
+@profiled
+@tracked
 def generate_audio():
     """Generate audio from text using Chatterbox TTS"""
     try:
         # Get form data
-        text = request.form.get('text', '').strip()
-        voice_name = request.form.get('voice', '')
-        cfg_scale = float(request.form.get('cfg', 0.4))
-        exaggeration = float(request.form.get('exaggeration', 0.3))
-        temperature = float(request.form.get('temperature', 0.5))
-        seed = int(request.form.get('seed', 0))
-        process = request.form.get('process') == 'on'
-        
-        # Validate input
-        if not text:
-            return jsonify({
-                'success': False, 
-                'error_message': 'Text is required',
-                'audio_url': ''
-            })
-        
-        if not process:
-            return jsonify({
-                'success': False, 
-                'error_message': 'Processing is disabled',
-                'audio_url': ''
-            })
-        
-        # Set device
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        if torch.backends.mps.is_available():
-            device = "mps"
-        
-        print(f"Using device: {device}")
+        params, error = parse_generate_params(request.form, api=False)
+        if error:
+            return jsonify(error)
         
         # Get voice path and language
-        try:
-            result = voice_mapper.get_voice_path_and_lang(voice_name)
-            
-            # Handle different return types
-            if isinstance(result, tuple) and len(result) == 2:
-                voice_path, lang = result
-            elif isinstance(result, str):
-                voice_path = result
-                # Try to extract language from voice name
-                lang = None
-                if '-' in voice_name:
-                    lang = voice_name.split('-')[0]
-            else:
-                # Fallback
-                voice_path = str(result)
-                lang = None
-                
-            print(f"Using voice: {os.path.basename(voice_path)}, Language: {lang or 'en'}")
-        except Exception as e:
-            # Fallback to first available voice file
-            print(f"Error getting voice: {e}, falling back to default")
-            voices_dir = os.path.join(os.path.dirname(__file__), "voices")
-            if os.path.exists(voices_dir):
-                wav_files = [f for f in os.listdir(voices_dir) if f.endswith('.wav')]
-                if wav_files:
-                    voice_path = os.path.join(voices_dir, wav_files[0])
-                    lang = None
-                    if '-' in wav_files[0]:
-                        lang = wav_files[0].split('-')[0]
-                    print(f"Fallback voice: {os.path.basename(voice_path)}, Language: {lang or 'en'}")
-                else:
-                    return jsonify({
-                        'success': False, 
-                        'error_message': 'No voice files available',
-                        'audio_url': ''
-                    })
-            else:
-                return jsonify({
-                    'success': False, 
-                    'error_message': 'No voices directory found',
-                    'audio_url': ''
-                })
-        
-        # Get model
-        model = get_model(device=device, lang=lang or 'en')
-        
-        # Set seed if provided
-        if seed > 0:
-            torch.manual_seed(seed)
-        
-        # Generate audio
-        print(f"Generating audio with cfg_scale={cfg_scale}, exaggeration={exaggeration}, temperature={temperature}")
-        
-        extra_args = {}
-        if lang and lang != 'en':
-            extra_args['language_id'] = lang
-        
-        # Add exaggeration and temperature parameters if supported
-        if hasattr(model, 'generate_with_settings'):
-            wav = model.generate_with_settings(
-                text, 
-                audio_prompt_path=voice_path, 
-                cfg_weight=cfg_scale,
-                exaggeration=exaggeration,
-                temperature=temperature,
-                **extra_args
-            )
-        else:
-            # Fallback to standard generate method
-            wav = model.generate(
-                text, 
-                audio_prompt_path=voice_path, 
-                cfg_weight=cfg_scale,
-                **extra_args
-            )
-        
-        # Generate unique filename
-        filename = f"output_{uuid.uuid4().hex[:8]}.wav"
-        output_path = os.path.join(OUTPUT_DIR, filename)
+        with phase('voice_resolution'):
+            try:
+                voice_path, lang = resolve_voice(params['voice'])
+            except LookupError as e:
+                return jsonify(error_response(str(e), api=False))
         
-        # Save audio file
-        ta.save(output_path, wav, model.sr)
-        print(f"Saved output to {output_path}")
-        
-        # Return success response with audio URL
-        return jsonify({
-            'success': True, 
-            'error_message': '',
-            'audio_url': f'/audio/{filename}'
-        })
+        note_voice_used(voice_path)
+        return jsonify(render_audio(params, voice_path, lang))
         
     except Exception as e:
         import traceback
@@ -285,9 +427,17 @@ def generate_audio():
 @app.route('/audio/<filename>')
 def serve_audio(filename):
     """Serve generated audio files"""
+    if filename.startswith(packs.AUDIO_PREFIX):
+        audio = packs.audio_slice(filename)
+        if audio is None:
+            abort(404)
+        # WSGI servers only accept bytes, so the slice of the pack is copied once here
+        return Response(bytes(audio), mimetype='audio/wav')
     return send_from_directory(OUTPUT_DIR, filename)
 
 @app.route('/api/generate', methods=['POST'])
+@profiled
+@tracked
 def api_generate_audio():
     """REST API endpoint for generating audio from text using Chatterbox TTS
     
@@ -299,6 +449,9 @@ def api_generate_audio():
     - temperature: Temperature for generation (0-1)
     - seed: Random seed (0 for random)
     - process: Whether to process the request (true/false)
+    - parallel: Split long text at sentence boundaries and synthesize up to this
+      many segments in parallel on model replicas (0 or 1 to disable)
+    - phrase_id: Id of a phrase in a prompt pack, used instead of text
     
     Returns JSON with:
     - success: true/false
@@ -307,141 +460,82 @@ def api_generate_audio():
     """
     try:
         # Get JSON data
-        data = request.get_json()
-        if not data:
-            return jsonify({
-                'success': False, 
-                'error_message': 'No JSON data provided'
-            })
-        
-        # Extract parameters
-        text = data.get('text', '').strip()
-        voice_name = data.get('voice', '')
-        cfg_scale = float(data.get('cfg', 0.4))
-        exaggeration = float(data.get('exaggeration', 0.3))
-        temperature = float(data.get('temperature', 0.5))
-        seed = int(data.get('seed', 0))
-        process = data.get('process', True)
-        
-        # Validate input
-        if not text:
-            return jsonify({
-                'success': False, 
-                'error_message': 'Text is required'
-            })
-        
-        if not process:
-            return jsonify({
-                'success': False, 
-                'error_message': 'Processing is disabled'
-            })
-        
-        # Set device
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        if torch.backends.mps.is_available():
-            device = "mps"
-        
-        print(f"API: Using device: {device}")
+        params, error = parse_generate_params(request.get_json())
+        if error:
+            return jsonify(error)
         
         # Get voice path and language
-        try:
-            result = voice_mapper.get_voice_path_and_lang(voice_name)
-            
-            # Handle different return types
-            if isinstance(result, tuple) and len(result) == 2:
-                voice_path, lang = result
-            elif isinstance(result, str):
-                voice_path = result
-                # Try to extract language from voice name
-                lang = None
-                if '-' in voice_name:
-                    lang = voice_name.split('-')[0]
-            else:
-                # Fallback
-                voice_path = str(result)
-                lang = None
-                
-            print(f"API: Using voice: {os.path.basename(voice_path)}, Language: {lang or 'en'}")
-        except Exception as e:
-            # Fallback to first available voice file
-            print(f"API: Error getting voice: {e}, falling back to default")
-            voices_dir = os.path.join(os.path.dirname(__file__), "voices")
-            if os.path.exists(voices_dir):
-                wav_files = [f for f in os.listdir(voices_dir) if f.endswith('.wav')]
-                if wav_files:
-                    voice_path = os.path.join(voices_dir, wav_files[0])
-                    lang = None
-                    if '-' in wav_files[0]:
-                        lang = wav_files[0].split('-')[0]
-                    print(f"API: Fallback voice: {os.path.basename(voice_path)}, Language: {lang or 'en'}")
-                else:
-                    return jsonify({
-                        'success': False, 
-                        'error_message': 'No voice files available'
-                    })
-            else:
-                return jsonify({
-                    'success': False, 
-                    'error_message': 'No voices directory found'
-                })
-        
-        # Get model
-        model = get_model(device=device, lang=lang or 'en')
-        
-        # Set seed if provided
-        if seed > 0:
-            torch.manual_seed(seed)
-        
-        # Generate audio
-        print(f"API: Generating audio with cfg_scale={cfg_scale}, exaggeration={exaggeration}, temperature={temperature}")
-        
-        extra_args = {}
-        if lang and lang != 'en':
-            extra_args['language_id'] = lang
-        
-        # Add exaggeration and temperature parameters if supported
-        if hasattr(model, 'generate_with_settings'):
-            wav = model.generate_with_settings(
-                text, 
-                audio_prompt_path=voice_path, 
-                cfg_weight=cfg_scale,
-                exaggeration=exaggeration,
-                temperature=temperature,
-                **extra_args
-            )
-        else:
-            # Fallback to standard generate method
-            wav = model.generate(
-                text, 
-                audio_prompt_path=voice_path, 
-                cfg_weight=cfg_scale,
-                **extra_args
-            )
+        with phase('voice_resolution'):
+            try:
+                voice_path, lang = resolve_voice(params['voice'], log_prefix='API: ')
+            except LookupError as e:
+                return jsonify(error_response(str(e)))
         
-        # Generate unique filename
-        filename = f"output_{uuid.uuid4().hex[:8]}.wav"
-        output_path = os.path.join(OUTPUT_DIR, filename)
+        note_voice_used(voice_path)
         
-        # Save audio file
-        ta.save(output_path, wav, model.sr)
-        print(f"API: Saved output to {output_path}")
-        
-        # Return success response with audio URL
-        return jsonify({
-            'success': True,
-            'error_message': '',
-            'audio_url': f'/audio/{filename}'
-        })
+        # Serve pre-rendered phrases from prompt packs without running the model
+        response = pack_response(params, voice_path)
+        if response is None:
+            response = render_audio(params, voice_path, lang, log_prefix='API: ')
+        return jsonify(response)
         
     except Exception as e:
         import traceback
         traceback.print_exc()
         return jsonify({
-            'success': False, 
+            'success': False,
             'error_message': str(e),
             'audio_url': ''
         })
 
+@app.route('/status')
+def get_status():
+    """Report warm models, available and recently used voices, and load
+
+    Used by the router to send requests to replicas that are already warm.
+    """
+    warm_models = {key.split('_', 1)[1] for key in loaded_pool_keys()}
+    with status_lock:
+        load = in_flight
+        warm_voices = list(reversed(recent_voices))
+    return jsonify({
+        'models': sorted(warm_models),
+        'voices': {name: lang or 'en' for name, (_, lang) in voice_mapper.voice_presets.items()},
+        'warm_voices': warm_voices,
+        'in_flight': load
+    })
+
+@app.route('/admin/profiles')
+def get_profiles():
+    """List captured request profiles, newest first"""
+    if not PROFILE_ENABLED:
+        abort(404)
+    return jsonify(list_profiles())
+
+@app.route('/admin/profiles/<profile_id>')
+def get_profile(profile_id):
+    """Serve a captured profile
+
+    Query parameters:
+    - format: 'chrome' (default) for Chrome-trace JSON, viewable in
+      chrome://tracing or Perfetto, or 'flamegraph' for folded stacks,
+      viewable with flamegraph.pl or speedscope (cProfile traces only)
+    """
+    if not PROFILE_ENABLED:
+        abort(404)
+    fmt = request.args.get('format', 'chrome')
+    if fmt == 'chrome':
+        path = profile_file(profile_id, 'trace.json')
+        if path is None:
+            return jsonify({'success': False, 'error_message': 'Profile not found'}), 404
+        return send_from_directory(os.path.dirname(path), 'trace.json', mimetype='application/json')
+    if fmt == 'flamegraph':
+        path = profile_file(profile_id, 'cprofile.prof')
+        if path is None:
+            return jsonify({'success': False, 'error_message': 'No cProfile data for this profile'}), 404
+        return Response(folded_stacks(path), mimetype='text/plain')
+    return jsonify({'success': False, 'error_message': f'Unknown format: {fmt}'}), 400
+
 def run_server(host='0.0.0.0', port=9080, debug=False):
     """Run the Flask server"""
     app.run(host=host, port=port, debug=debug)
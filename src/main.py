@@ -1,7 +1,6 @@
 
 import argparse
 import os
-from .http_server import run_server
 from .setup_voices import setup_voices
 
 def parse_args():
@@ -10,6 +9,7 @@ def parse_args():
     parser.add_argument('--port', type=int, default=9080, help='Port to run the server on')
     parser.add_argument('--debug', action='store_true', help='Run in debug mode', default=os.getenv('DEBUG', False) == "yes")
     parser.add_argument('--skip-setup', action='store_true', help='Skip voice setup')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='Run the async server, which offloads inference to a fixed-size executor', default=os.getenv('ASYNC_SERVER', False) == "yes")
     return parser.parse_args()
 
 def main():
@@ -25,8 +25,16 @@ def main():
     os.makedirs(output_dir, exist_ok=True)
     print(f"Output directory: {output_dir}")
     
-    print(f"Starting Chatterbox TTS Web Server on {args.host}:{args.port}")
-    run_server(host=args.host, port=args.port, debug=args.debug)
+    # The servers are imported after setup so that the voice mapper reads the fresh manifest
+    if args.use_async:
+        # Imported here so that aiohttp is only needed for the async server
+        from .async_server import run_async_server
+        print(f"Starting Chatterbox TTS async Web Server on {args.host}:{args.port}")
+        run_async_server(host=args.host, port=args.port, debug=args.debug)
+    else:
+        from .http_server import run_server
+        print(f"Starting Chatterbox TTS Web Server on {args.host}:{args.port}")
+        run_server(host=args.host, port=args.port, debug=args.debug)
 
 if __name__ == "__main__":
     main()
@@ -1,12 +1,20 @@
+import os
+import threading
+import time
 import torch
 import numpy as np
 
+# Simulated inference time per input character, to make latency measurable in benchmarks
+MOCK_TTS_SECONDS_PER_CHAR = float(os.environ.get('MOCK_TTS_SECONDS_PER_CHAR', 0))
+
 class MockTTSBase:
     """Mock TTS class for testing the UI without actual TTS models"""
     
     def __init__(self, device="cpu"):
         self.device = device
         self.sr = 22050  # Sample rate
+        # A model instance runs one inference at a time, like a real model on its device
+        self._inference_lock = threading.Lock()
         print(f"Initialized Mock TTS on {device}")
     
     @classmethod
@@ -19,6 +27,12 @@ class MockTTSBase:
         t = np.linspace(0, duration_sec, int(self.sr * duration_sec), endpoint=False)
         wave = 0.5 * np.sin(2 * np.pi * freq * t)
         return torch.tensor(wave.reshape(1, -1), dtype=torch.float32)
+    
+    def simulate_inference(self, text):
+        """Sleep for as long as the configured per-character inference time"""
+        if MOCK_TTS_SECONDS_PER_CHAR > 0:
+            with self._inference_lock:
+                time.sleep(len(text) * MOCK_TTS_SECONDS_PER_CHAR)
 
 class MockChatterboxTTS(MockTTSBase):
     """Mock implementation of ChatterboxTTS"""
@@ -31,6 +45,7 @@ class MockChatterboxTTS(MockTTSBase):
         # Text length affects duration
         duration = min(len(text) / 20, 10)  # Max 10 seconds
         duration = max(duration, 1)  # Min 1 second
+        self.simulate_inference(text)
         
         # Generate different frequencies based on the voice prompt
         if audio_prompt_path and "woman" in audio_prompt_path:
@@ -83,5 +98,6 @@ class MockChatterboxMultilingualTTS(MockChatterboxTTS):
         # Text length affects duration
         duration = min(len(text) / 20, 10)  # Max 10 seconds
         duration = max(duration, 1)  # Min 1 second
+        self.simulate_inference(text)
         
         return self.generate_sine_wave(freq, duration)
@@ -0,0 +1,331 @@
+import argparse
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import wave
+
+# Configuration
+PACKS_DIR = os.environ.get('PACKS_DIR', os.path.join(os.path.dirname(__file__), '..', 'packs'))
+
+PACK_SUFFIX = '.pack'
+PACK_VERSION = 1
+# Archive layout: header, the WAV file of every entry back to back, then the JSON index
+PACK_MAGIC = b'CBXPACK1'
+_HEADER = struct.Struct('<8sQQ')
+# Prefix of the /audio file names served from packs instead of OUTPUT_DIR
+AUDIO_PREFIX = 'pack-'
+
+# Generation settings a pack is rendered with, same defaults as /api/generate
+DEFAULT_SETTINGS = {
+    'cfg': 0.4,
+    'exaggeration': 0.3,
+    'temperature': 0.5,
+    'seed': 0,
+}
+
+
+def normalize_text(text):
+    return ' '.join(text.split())
+
+
+def text_hash(text):
+    """Hash of a phrase's text, insensitive to surrounding and repeated whitespace"""
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()[:16]
+
+
+def settings_key(settings):
+    """Canonical string of the settings that affect the rendered audio"""
+    return json.dumps({
+        name: round(float(settings.get(name, default)), 4)
+        for name, default in DEFAULT_SETTINGS.items()
+        if name != 'seed'
+    }, sort_keys=True)
+
+
+def encode_wav(wav, sr):
+    """Encode a mono waveform tensor as 16-bit PCM WAV bytes"""
+    samples = wav.detach().cpu().reshape(-1).clamp(-1, 1)
+    pcm = (samples * 32767).short().numpy().astype('<i2').tobytes()
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sr)
+        f.writeframes(pcm)
+    return buffer.getvalue()
+
+
+class PromptPack:
+    """A memory-mapped pack of pre-rendered phrases, keyed by (voice, text hash)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)[:-len(PACK_SUFFIX)]
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.ino, self.mtime_ns, self.size = st.st_ino, st.st_mtime_ns, st.st_size
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_length = _HEADER.unpack_from(self.mmap, 0)
+        if magic != PACK_MAGIC:
+            raise ValueError(f"Not a prompt pack: {path}")
+        self.index = json.loads(self.mmap[index_offset:index_offset + index_length])
+        if self.index.get('version') != PACK_VERSION:
+            raise ValueError(f"Unsupported prompt pack version in {path}")
+        self.view = memoryview(self.mmap)
+
+    def changed(self):
+        """Whether the file at the pack's path was replaced or rewritten since it was loaded"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        return (st.st_ino, st.st_mtime_ns, st.st_size) != (self.ino, self.mtime_ns, self.size)
+
+    def rewritten_in_place(self):
+        """Whether the mapped file itself was modified, rather than replaced by a rename"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return st.st_ino == self.ino and (st.st_mtime_ns, st.st_size) != (self.mtime_ns, self.size)
+
+    def find(self, voice, text=None, phrase_id=None, settings=None):
+        """Return the entry key for a phrase id, or for a text rendered with the same settings"""
+        if phrase_id:
+            return self.index['phrases'].get(f"{voice}/{phrase_id}")
+        if text:
+            key = f"{voice}/{text_hash(text)}"
+            if key in self.index['entries'] and settings_key(settings or {}) == self.index['settings_key']:
+                return key
+        return None
+
+    def audio(self, key):
+        """Return the WAV file of an entry as a zero-copy slice of the mapped archive"""
+        entry = self.index['entries'][key]
+        return self.view[entry['offset']:entry['offset'] + entry['length']]
+
+    def audio_filename(self, key):
+        voice, digest = key.split('/', 1)
+        return f"{AUDIO_PREFIX}{self.name}-{voice}-{digest}.wav"
+
+
+# Packs loaded from PACKS_DIR, reloaded when a pack file is added, replaced or removed
+_packs = {}
+_audio_files = {}
+_packs_dir_mtime = None
+_packs_lock = threading.Lock()
+
+
+def _packs_dir_mtime_ns():
+    try:
+        return os.stat(PACKS_DIR).st_mtime_ns
+    except OSError:
+        return None
+
+
+def refresh():
+    """Load new and rebuilt packs from PACKS_DIR and drop removed ones
+
+    Files added, removed or renamed into place change the directory's mtime.
+    Every loaded pack is checked as well, to catch packs rewritten in place,
+    which are reloaded with a warning.
+    """
+    global _packs, _audio_files, _packs_dir_mtime
+    dir_mtime = _packs_dir_mtime_ns()
+    if dir_mtime == _packs_dir_mtime and not any(pack.changed() for pack in _packs.values()):
+        return
+
+    with _packs_lock:
+        if dir_mtime == _packs_dir_mtime and not any(pack.changed() for pack in _packs.values()):
+            return
+        packs = {}
+        names = sorted(os.listdir(PACKS_DIR)) if dir_mtime is not None else []
+        for filename in names:
+            if not filename.endswith(PACK_SUFFIX):
+                continue
+            path = os.path.join(PACKS_DIR, filename)
+            old = _packs.get(path)
+            try:
+                if old is not None and not old.changed():
+                    packs[path] = old
+                else:
+                    if old is not None and old.rewritten_in_place():
+                        print(f"WARNING: Prompt pack {path} was overwritten in place while memory-mapped. "
+                              f"Reading it during the rewrite can kill the server with SIGBUS. "
+                              f"Deploy packs by writing a temporary file and renaming it into place.")
+                    packs[path] = PromptPack(path)
+                    print(f"Loaded prompt pack {path} with {len(packs[path].index['entries'])} phrases")
+            except (OSError, ValueError) as e:
+                print(f"Warning: Could not load prompt pack {path}: {e}")
+
+        audio_files = {}
+        for pack in packs.values():
+            for key in pack.index['entries']:
+                audio_files[pack.audio_filename(key)] = (pack, key)
+
+        # Old packs stay mapped while slices of them are still being sent
+        _packs, _audio_files, _packs_dir_mtime = packs, audio_files, dir_mtime
+
+
+def lookup(voice, text=None, phrase_id=None, settings=None):
+    """Return the /audio file name of a pre-rendered phrase, or None"""
+    refresh()
+    for pack in _packs.values():
+        key = pack.find(voice, text, phrase_id, settings)
+        if key is not None:
+            return pack.audio_filename(key)
+    return None
+
+
+def audio_slice(filename):
+    """Return the WAV bytes of a pack /audio file name as a memoryview, or None"""
+    refresh()
+    found = _audio_files.get(filename)
+    if found is None:
+        return None
+    pack, key = found
+    return pack.audio(key)
+
+
+def build_pack(manifest_path, name=None, output_dir=None, device=None):
+    """Render a phrase manifest into a pack, reusing entries whose text, voice and settings are unchanged
+
+    The manifest is JSON:
+    {
+      "name": "ivr",
+      "voices": ["Carter", "Xinran"],
+      "settings": {"cfg": 0.4, "exaggeration": 0.3, "temperature": 0.5, "seed": 0},
+      "phrases": [{"id": "welcome", "text": "Welcome!", "voices": ["Carter"]}, ...]
+    }
+    "voices" of a phrase overrides the manifest's voices; "id" is optional.
+    """
+    # Imported here so that serving packs doesn't need the models
+    import torch
+    from . import http_server
+    from .setup_voices import file_hash
+
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    name = name or manifest.get('name') or os.path.splitext(os.path.basename(manifest_path))[0]
+    output_dir = output_dir or PACKS_DIR
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, name + PACK_SUFFIX)
+
+    settings = dict(DEFAULT_SETTINGS, **manifest.get('settings', {}))
+    current_settings = settings_key(settings)
+
+    old = None
+    if os.path.exists(path):
+        try:
+            old = PromptPack(path)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Rebuilding {path} from scratch: {e}")
+
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        if torch.backends.mps.is_available():
+            device = "mps"
+
+    voices = {}
+
+    def resolve_voice(voice_name):
+        if voice_name not in voices:
+            voice_path, lang = http_server.voice_mapper.get_voice_path_and_lang(voice_name)
+            voices[voice_name] = (
+                http_server.voice_preset_name(voice_path), voice_path, lang or 'en', file_hash(voice_path)
+            )
+        return voices[voice_name]
+
+    entries = {}
+    phrases = {}
+    rendered = reused = 0
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(PACK_MAGIC, 0, 0))
+        for phrase in manifest['phrases']:
+            text = phrase['text']
+            digest = text_hash(text)
+            for voice_name in phrase.get('voices', manifest.get('voices', [])):
+                voice, voice_path, lang, voice_sha256 = resolve_voice(voice_name)
+                key = f"{voice}/{digest}"
+                if phrase.get('id'):
+                    phrases[f"{voice}/{phrase['id']}"] = key
+                if key in entries:
+                    continue
+
+                old_entry = old.index['entries'].get(key) if old else None
+                if (old_entry and old_entry['voice_sha256'] == voice_sha256
+                        and old.index['settings_key'] == current_settings):
+                    data = old.audio(key)
+                    reused += 1
+                else:
+                    print(f"Rendering '{normalize_text(text)[:50]}' with voice {voice}")
+                    extra_args = {'language_id': lang} if lang != 'en' else {}
+                    with http_server.borrowed_model(device=device, lang=lang) as model:
+                        if settings['seed'] > 0:
+                            torch.manual_seed(settings['seed'])
+                        wav = http_server.synthesize(
+                            model, text, voice_path, settings['cfg'], settings['exaggeration'],
+                            settings['temperature'], extra_args
+                        )
+                    data = encode_wav(wav, model.sr)
+                    rendered += 1
+
+                entries[key] = {
+                    'offset': f.tell(),
+                    'length': len(data),
+                    'voice': voice,
+                    'text_hash': digest,
+                    'voice_sha256': voice_sha256,
+                }
+                f.write(data)
+
+        index = json.dumps({
+            'version': PACK_VERSION,
+            'name': name,
+            'settings': settings,
+            'settings_key': current_settings,
+            'entries': entries,
+            'phrases': phrases,
+        }).encode('utf-8')
+        index_offset = f.tell()
+        f.write(index)
+        f.seek(0)
+        f.write(_HEADER.pack(PACK_MAGIC, index_offset, len(index)))
+
+    # Replacing the file atomically lets running servers keep serving the old pack until they reload
+    os.replace(tmp_path, path)
+    print(f"Built prompt pack {path}: {len(entries)} phrases, {rendered} rendered, {reused} reused")
+    return path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Build prompt packs of pre-rendered phrases')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='Render a phrase manifest into a pack')
+    build.add_argument('manifest', help='Phrase manifest (JSON)')
+    build.add_argument('--name', help='Pack name (default: the manifest name or file name)')
+    build.add_argument('--output-dir', default=PACKS_DIR, help='Directory to write the pack to')
+    build.add_argument('--device', help='Device to render on (default: cuda, mps or cpu)')
+    subparsers.add_parser('list', help='List the packs in PACKS_DIR')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == 'build':
+        build_pack(args.manifest, name=args.name, output_dir=args.output_dir, device=args.device)
+    else:
+        refresh()
+        for pack in _packs.values():
+            print(f"{pack.name}: {len(pack.index['entries'])} phrases, "
+                  f"{len(pack.index['phrases'])} phrase ids, {os.path.getsize(pack.path)} bytes")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,297 @@
+import cProfile
+import json
+import os
+import pstats
+import random
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from flask import request, make_response
+
+# Configuration
+# Profiling, including the X-Profile header and the /admin/profiles routes, is only available when enabled
+PROFILE_ENABLED = os.environ.get('PROFILE_ENABLED', 'no') == "yes"
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(os.path.dirname(__file__), '..', 'profiles'))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'cprofile').lower()
+PROFILE_MAX_TRACES = int(os.environ.get('PROFILE_MAX_TRACES', 50))
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ID_HEADER = 'X-Profile-Id'
+MODES = ('cprofile', 'torch', 'both')
+
+_PROFILE_ID_RE = re.compile(r'^[0-9]{8}-[0-9]{6}-[0-9a-f]{8}$')
+_NULL_PHASE = nullcontext()
+
+# The profile of the request handled by the current thread, if any
+_local = threading.local()
+# torch.profiler only supports one active session per process
+_torch_lock = threading.Lock()
+_store_lock = threading.Lock()
+
+
+class RequestProfile:
+    """Captures a cProfile and/or torch.profiler trace for a single request"""
+
+    def __init__(self, mode, endpoint):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.mode = mode
+        self.endpoint = endpoint
+        self.phases = []
+        self.started_at = None
+        self.duration = None
+        self._t0 = None
+        self._cprofile = None
+        self._torch = None
+
+    def start(self):
+        """Start the profilers selected by the profile mode"""
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+
+        if self.mode in ('torch', 'both'):
+            self._start_torch()
+
+        # Fall back to cProfile if the torch profiler could not be started
+        if self.mode in ('cprofile', 'both') or self._torch is None:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def _start_torch(self):
+        if not _torch_lock.acquire(blocking=False):
+            print(f"Profiling: torch profiler busy, using cProfile for {self.id}")
+            return
+        try:
+            import torch
+            from torch.profiler import profile, ProfilerActivity
+            activities = [ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(ProfilerActivity.CUDA)
+            self._torch = profile(activities=activities, record_shapes=True)
+            self._torch.__enter__()
+        except Exception as e:
+            print(f"Profiling: could not start torch profiler: {e}")
+            self._torch = None
+            _torch_lock.release()
+
+    def stop(self):
+        """Stop all running profilers"""
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        if self._torch is not None:
+            try:
+                self._torch.__exit__(None, None, None)
+            finally:
+                _torch_lock.release()
+        self.duration = time.perf_counter() - self._t0
+
+    @contextmanager
+    def phase(self, name):
+        """Record a named phase (voice resolution, generation, ...) of the request"""
+        start = time.perf_counter()
+        record = nullcontext()
+        if self._torch is not None:
+            from torch.profiler import record_function
+            record = record_function(name)
+        try:
+            with record:
+                yield
+        finally:
+            self.phases.append({
+                'name': name,
+                'start_ms': (start - self._t0) * 1000,
+                'duration_ms': (time.perf_counter() - start) * 1000,
+            })
+
+    def metadata(self):
+        return {
+            'id': self.id,
+            'endpoint': self.endpoint,
+            'mode': self.mode,
+            'started_at': self.started_at,
+            'duration_ms': self.duration * 1000 if self.duration is not None else None,
+            'phases': self.phases,
+            'torch': self._torch is not None,
+            'cprofile': self._cprofile is not None,
+        }
+
+    def save(self):
+        """Write the trace files and prune old traces"""
+        trace_dir = os.path.join(PROFILE_DIR, self.id)
+        os.makedirs(trace_dir, exist_ok=True)
+
+        chrome_path = os.path.join(trace_dir, 'trace.json')
+        if self._torch is not None:
+            # The torch trace already contains the phases as record_function spans
+            self._torch.export_chrome_trace(chrome_path)
+        else:
+            with open(chrome_path, 'w') as f:
+                json.dump(self._phase_trace(), f)
+
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(os.path.join(trace_dir, 'cprofile.prof'))
+
+        with open(os.path.join(trace_dir, 'meta.json'), 'w') as f:
+            json.dump(self.metadata(), f)
+
+        prune_profiles()
+        print(f"Profiling: saved trace {self.id} for {self.endpoint} to {trace_dir}")
+
+    def _phase_trace(self):
+        """Build a Chrome trace from the recorded phases"""
+        pid = os.getpid()
+        tid = threading.get_ident()
+        events = [{
+            'name': self.endpoint,
+            'cat': 'request',
+            'ph': 'X',
+            'ts': 0,
+            'dur': self.duration * 1e6,
+            'pid': pid,
+            'tid': tid,
+        }]
+        for item in self.phases:
+            events.append({
+                'name': item['name'],
+                'cat': 'phase',
+                'ph': 'X',
+                'ts': item['start_ms'] * 1000,
+                'dur': item['duration_ms'] * 1000,
+                'pid': pid,
+                'tid': tid,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def phase(name):
+    """Mark a phase of the current request's profile (no-op when not profiling)"""
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return _NULL_PHASE
+    return profile.phase(name)
+
+
+def requested_mode(headers):
+    """Return the profile mode for a request with the given headers, or None to skip profiling"""
+    if not PROFILE_ENABLED:
+        return None
+    value = headers.get(PROFILE_HEADER)
+    if value:
+        value = value.strip().lower()
+        if value in MODES:
+            return value
+        if value in ('1', 'true', 'yes', 'on'):
+            return PROFILE_MODE
+        return None
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return PROFILE_MODE
+    return None
+
+
+def profiled(view):
+    """Profile a Flask view when requested by header or picked by the sample rate
+
+    The view is returned unwrapped when profiling is not enabled.
+    """
+    if not PROFILE_ENABLED:
+        return view
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        mode = requested_mode(request.headers)
+        if mode is None:
+            return view(*args, **kwargs)
+
+        response, profile_id = run_profiled(mode, request.path, view, *args, **kwargs)
+        response = make_response(response)
+        response.headers[PROFILE_ID_HEADER] = profile_id
+        return response
+    return wrapper
+
+
+def run_profiled(mode, endpoint, fn, *args, **kwargs):
+    """Call fn on this thread under a new profile and return (result, profile id)"""
+    profile = RequestProfile(mode, endpoint)
+    _local.profile = profile
+    profile.start()
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        profile.stop()
+        _local.profile = None
+        try:
+            profile.save()
+        except Exception as e:
+            print(f"Profiling: failed to save trace {profile.id}: {e}")
+    return result, profile.id
+
+
+def prune_profiles():
+    """Remove the oldest traces so that at most PROFILE_MAX_TRACES are kept"""
+    with _store_lock:
+        if not os.path.exists(PROFILE_DIR):
+            return
+        trace_ids = sorted(d for d in os.listdir(PROFILE_DIR) if _PROFILE_ID_RE.match(d))
+        for trace_id in trace_ids[:max(len(trace_ids) - PROFILE_MAX_TRACES, 0)]:
+            shutil.rmtree(os.path.join(PROFILE_DIR, trace_id), ignore_errors=True)
+
+
+def list_profiles():
+    """Return the metadata of the stored traces, newest first"""
+    profiles = []
+    if not os.path.exists(PROFILE_DIR):
+        return profiles
+    for trace_id in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        meta_path = os.path.join(PROFILE_DIR, trace_id, 'meta.json')
+        if not _PROFILE_ID_RE.match(trace_id) or not os.path.exists(meta_path):
+            continue
+        try:
+            with open(meta_path) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Profiling: could not read {meta_path}: {e}")
+    return profiles
+
+
+def profile_file(trace_id, filename):
+    """Return the path of a stored trace file, or None if it does not exist"""
+    if not _PROFILE_ID_RE.match(trace_id):
+        return None
+    path = os.path.join(PROFILE_DIR, trace_id, filename)
+    return path if os.path.exists(path) else None
+
+
+def _frame_label(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def folded_stacks(prof_path):
+    """Convert cProfile stats to folded stacks for flamegraph.pl or speedscope
+
+    cProfile only records caller/callee pairs, so each function's own time is
+    attributed to the stack formed by following its most expensive callers.
+    """
+    stats = pstats.Stats(prof_path).stats
+    folded = defaultdict(int)
+    for func, (_, _, self_time, _, _) in stats.items():
+        if self_time <= 0:
+            continue
+        stack = [func]
+        current = func
+        while True:
+            callers = [c for c in stats[current][4] if c in stats and c not in stack]
+            if not callers:
+                break
+            current = max(callers, key=lambda c: stats[current][4][c][3])
+            stack.append(current)
+        key = ';'.join(_frame_label(f).replace(';', ',') for f in reversed(stack))
+        folded[key] += int(self_time * 1e6)
+    return '\n'.join(f"{key} {value}" for key, value in sorted(folded.items()) if value > 0) + '\n'
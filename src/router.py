@@ -0,0 +1,366 @@
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+import aiohttp
+from aiohttp import web
+
+# Configuration
+HEALTH_INTERVAL = float(os.environ.get('ROUTER_HEALTH_INTERVAL', 2))
+HEALTH_TIMEOUT = float(os.environ.get('ROUTER_HEALTH_TIMEOUT', 2))
+# A replica with this many generations in progress is full and overflow spills to other replicas
+MAX_LOAD = int(os.environ.get('ROUTER_MAX_LOAD', 2))
+REQUEST_TIMEOUT = float(os.environ.get('ROUTER_REQUEST_TIMEOUT', 600))
+VIRTUAL_NODES = 64
+# Generated files remembered so that /audio requests go to the replica that wrote them
+AUDIO_ROUTES = 10000
+
+# Headers recomputed by the receiving side when a request or response is forwarded
+HOP_HEADERS = ('content-length', 'transfer-encoding', 'connection', 'keep-alive', 'host')
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class Replica:
+    """State of one TTS server as seen by the router"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.healthy = False
+        self.models = set()
+        self.voices = {}
+        self.warm_voices = set()
+        self.reported_load = 0
+        # Requests this router is waiting on, counted immediately unlike the polled load
+        self.in_flight = 0
+        self.last_seen = None
+
+    @property
+    def load(self):
+        return max(self.in_flight, self.reported_load)
+
+    def update(self, status):
+        self.healthy = True
+        self.models = set(status.get('models', []))
+        self.voices = status.get('voices', {})
+        self.warm_voices = set(status.get('warm_voices', []))
+        self.reported_load = status.get('in_flight', 0)
+        self.last_seen = time.time()
+
+    def describe(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'models': sorted(self.models),
+            'warm_voices': sorted(self.warm_voices),
+            'in_flight': self.in_flight,
+            'reported_load': self.reported_load,
+            'last_seen': self.last_seen,
+        }
+
+
+class HashRing:
+    """Consistent hash ring over replicas, with virtual nodes to spread keys evenly"""
+
+    def __init__(self, replicas, virtual_nodes=VIRTUAL_NODES):
+        self.ring = sorted(
+            (_hash(f"{replica.url}#{i}"), replica)
+            for replica in replicas
+            for i in range(virtual_nodes)
+        )
+        self.hashes = [h for h, _ in self.ring]
+
+    def walk(self, key):
+        """Yield every replica once, in ring order starting from the key's position"""
+        start = bisect.bisect(self.hashes, _hash(key))
+        seen = set()
+        for i in range(len(self.ring)):
+            replica = self.ring[(start + i) % len(self.ring)][1]
+            if replica.url not in seen:
+                seen.add(replica.url)
+                yield replica
+
+
+class Router:
+    """Routes generation requests to replicas by (lang, voice) affinity"""
+
+    def __init__(self, urls, max_load=MAX_LOAD):
+        self.replicas = [Replica(url) for url in urls]
+        self.ring = HashRing(self.replicas)
+        self.max_load = max_load
+        self.audio_routes = OrderedDict()
+        self.session = None
+
+    def resolve_voice(self, voice_name):
+        """Map a requested voice to (lang, preset name) like VoiceMapper does"""
+        voices = {}
+        for replica in self.replicas:
+            voices.update(replica.voices)
+        if voice_name in voices:
+            return voices[voice_name], voice_name
+        voice_lower = voice_name.lower()
+        for name, lang in voices.items():
+            if name.lower() in voice_lower or voice_lower in name.lower():
+                return lang, name
+        return 'en', voice_name
+
+    def candidates(self, lang, voice):
+        """Order healthy replicas for a (lang, voice) key
+
+        The replica owning the key on the hash ring comes first unless it is full.
+        Overflow goes to replicas with spare capacity, preferring ones with the
+        voice and then the language model already warm. When every replica is
+        full, the least loaded ones come first.
+        """
+        ordered = [r for r in self.ring.walk(f"{lang}:{voice}") if r.healthy]
+        if not ordered or ordered[0].load < self.max_load:
+            return ordered
+        spare = [r for r in ordered[1:] if r.load < self.max_load]
+        if spare:
+            spare.sort(key=lambda r: (voice not in r.warm_voices, lang not in r.models))
+            return spare + [r for r in ordered if r not in spare]
+        return sorted(ordered, key=lambda r: r.load)
+
+    def remember_audio(self, replica, payload):
+        """Remember which replica wrote the audio file named in a generation response"""
+        try:
+            audio_url = json.loads(payload).get('audio_url', '')
+        except (ValueError, AttributeError):
+            return
+        if audio_url:
+            self.audio_routes[audio_url.rsplit('/', 1)[-1]] = replica
+            while len(self.audio_routes) > AUDIO_ROUTES:
+                self.audio_routes.popitem(last=False)
+
+    async def check(self, replica):
+        """Poll a replica's /status and update its health"""
+        try:
+            timeout = aiohttp.ClientTimeout(total=HEALTH_TIMEOUT)
+            async with self.session.get(f"{replica.url}/status", timeout=timeout) as response:
+                response.raise_for_status()
+                status = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            if replica.healthy:
+                print(f"Router: replica {replica.url} is down: {e!r}")
+            replica.healthy = False
+            return
+        if not replica.healthy:
+            print(f"Router: replica {replica.url} is up")
+        replica.update(status)
+
+    async def health_loop(self):
+        while True:
+            await asyncio.gather(*(self.check(replica) for replica in self.replicas))
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def send(self, replica, request, body, data=None):
+        """Forward a request to a replica and return (status, headers, payload)
+
+        data, if given, is a list of form fields sent instead of body.
+        """
+        skip = HOP_HEADERS + ('accept-encoding',)
+        if data is not None:
+            # The form is re-encoded, so let aiohttp set its content type
+            skip += ('content-type',)
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in skip}
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        replica.in_flight += 1
+        try:
+            async with self.session.request(
+                request.method, f"{replica.url}{request.path_qs}", headers=headers,
+                data=aiohttp.FormData(data) if data is not None else body, timeout=timeout
+            ) as response:
+                return response.status, response.headers.copy(), await response.read()
+        finally:
+            replica.in_flight -= 1
+
+    async def forward(self, replicas, request, body=b'', data=None):
+        """Forward to the first replica that answers, failing over on client errors and timeouts
+
+        A 503, which a draining replica answers with, also fails over. A replica
+        that fails is skipped until its next successful health check. If every
+        replica answers 503, the last answer is returned.
+        """
+        unavailable = (None, None)
+        for replica in replicas:
+            try:
+                result = await self.send(replica, request, body, data)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Router: {request.path} failed on {replica.url}: {e!r}, failing over")
+                replica.healthy = False
+                continue
+            if result[0] == 503:
+                print(f"Router: {request.path} unavailable on {replica.url}, failing over")
+                replica.healthy = False
+                unavailable = (replica, result)
+                continue
+            return replica, result
+        return unavailable
+
+
+ROUTER = web.AppKey('router', Router)
+HEALTH_TASK = web.AppKey('health_task', asyncio.Task)
+
+
+def _response(result):
+    status, headers, payload = result
+    response = web.Response(status=status, body=payload)
+    for key, value in headers.items():
+        if key.lower() not in HOP_HEADERS:
+            response.headers.add(key, value)
+    return response
+
+
+def _unavailable():
+    return web.json_response({
+        'success': False,
+        'error_message': 'No healthy TTS replica available',
+        'audio_url': ''
+    }, status=503)
+
+
+async def generate(request):
+    """Route /generate and /api/generate by (lang, voice)"""
+    router = request.app[ROUTER]
+    body = b''
+    data = None
+    voice_name = ''
+    if request.path == '/api/generate':
+        body = await request.read()
+        try:
+            voice_name = str((json.loads(body) or {}).get('voice', ''))
+        except (ValueError, AttributeError):
+            voice_name = ''
+    elif request.method == 'POST':
+        # The web UI posts a form, which is parsed and re-encoded for the replica
+        form = await request.post()
+        voice_name = str(form.get('voice', ''))
+        data = [(key, str(value)) for key, value in form.items()]
+
+    lang, voice = router.resolve_voice(voice_name)
+    replica, result = await router.forward(router.candidates(lang, voice), request, body, data)
+    if replica is None:
+        return _unavailable()
+    print(f"Router: {request.path} lang={lang} voice={voice} -> {replica.url}")
+    router.remember_audio(replica, result[2])
+    return _response(result)
+
+
+async def serve_audio(request):
+    """Serve audio from the replica that generated it, searching all replicas if unknown"""
+    router = request.app[ROUTER]
+    filename = request.match_info['filename']
+    known = router.audio_routes.get(filename)
+    replicas = [r for r in router.replicas if r.healthy and r is not known]
+    if known is not None and known.healthy:
+        replicas.insert(0, known)
+    for replica in replicas:
+        found, result = await router.forward([replica], request)
+        if found is not None and result[0] != 404:
+            return _response(result)
+    raise web.HTTPNotFound()
+
+
+async def forward_any(request):
+    """Forward replica-independent routes (/, /voices) to any healthy replica"""
+    router = request.app[ROUTER]
+    replica, result = await router.forward([r for r in router.replicas if r.healthy], request)
+    if replica is None:
+        return _unavailable()
+    return _response(result)
+
+
+async def get_status(request):
+    router = request.app[ROUTER]
+    return web.json_response({
+        'max_load': router.max_load,
+        'replicas': [replica.describe() for replica in router.replicas],
+    })
+
+
+async def on_startup(app):
+    router = app[ROUTER]
+    router.session = aiohttp.ClientSession()
+    # Learn the replicas' state before taking traffic
+    await asyncio.gather(*(router.check(replica) for replica in router.replicas))
+    app[HEALTH_TASK] = asyncio.create_task(router.health_loop())
+
+
+async def on_cleanup(app):
+    app[HEALTH_TASK].cancel()
+    await app[ROUTER].session.close()
+
+
+def create_app(urls, max_load=MAX_LOAD):
+    """Create the router app for the given replica URLs"""
+    app = web.Application()
+    app[ROUTER] = Router(urls, max_load=max_load)
+    app.router.add_route('*', '/generate', generate)
+    app.router.add_route('*', '/api/generate', generate)
+    app.router.add_get('/audio/{filename}', serve_audio)
+    app.router.add_get('/router/status', get_status)
+    app.router.add_get('/', forward_any)
+    app.router.add_get('/voices', forward_any)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def spawn_mock_replicas(count, base_port):
+    """Start mock-backend TTS servers on consecutive ports for local testing"""
+    env = dict(os.environ, MOCK_TTS='yes')
+    processes = []
+    urls = []
+    for i in range(count):
+        port = base_port + i
+        print(f"Router: starting mock replica on port {port}")
+        processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'src.main', '--host', '127.0.0.1', '--port', str(port), '--skip-setup'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env=env
+        ))
+        urls.append(f"http://127.0.0.1:{port}")
+    return processes, urls
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Chatterbox TTS router')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to run the router on')
+    parser.add_argument('--port', type=int, default=9080, help='Port to run the router on')
+    parser.add_argument('--replicas', nargs='*', default=[u for u in os.getenv('ROUTER_REPLICAS', '').split(',') if u],
+                        help='Replica base URLs, e.g. http://tts-1:9080 (default: ROUTER_REPLICAS, comma separated)')
+    parser.add_argument('--max-load', type=int, default=MAX_LOAD, help='Generations in progress at which a replica spills overflow')
+    parser.add_argument('--mock-replicas', type=int, default=0, help='Start this many mock-backend replicas for local testing')
+    parser.add_argument('--mock-base-port', type=int, default=9181, help='First port of the mock replicas')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    processes = []
+    urls = list(args.replicas)
+    if args.mock_replicas:
+        processes, mock_urls = spawn_mock_replicas(args.mock_replicas, args.mock_base_port)
+        urls += mock_urls
+    if not urls:
+        print("Error: no replicas given, use --replicas or --mock-replicas")
+        sys.exit(1)
+
+    print(f"Starting Chatterbox TTS router on {args.host}:{args.port} for {', '.join(urls)}")
+    try:
+        web.run_app(create_app(urls, max_load=args.max_load), host=args.host, port=args.port)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
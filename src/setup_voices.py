@@ -1,51 +1,239 @@
 #!/usr/bin/env python3
+import hashlib
+import json
 import os
 import shutil
 import sys
+import torch
+import torchaudio as ta
+
+# Native sample rate of the Chatterbox decoder, which consumes the voice prompt
+try:
+    from chatterbox.models.s3gen import S3GEN_SR as PROMPT_SAMPLE_RATE
+except ImportError:
+    PROMPT_SAMPLE_RATE = 24000
+
+# Chatterbox only conditions on the first 10 seconds of the prompt
+PROMPT_MAX_SECONDS = 10
+# Frames quieter than this (relative to the peak) are trimmed from both ends
+SILENCE_THRESHOLD_DB = -40
+SILENCE_FRAME_SECONDS = 0.02
+SILENCE_PAD_SECONDS = 0.1
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+PROMPTS_DIR = "prompts"
+
+def load_manifest(voices_dir):
+    """Load the voice manifest from a voices directory, or None if missing or stale"""
+    manifest_path = os.path.join(voices_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read voice manifest {manifest_path}: {e}")
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def save_manifest(voices_dir, manifest):
+    """Atomically write the voice manifest"""
+    manifest_path = os.path.join(voices_dir, MANIFEST_FILE)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+def file_hash(path, entry=None):
+    """Return the sha256 of a file, reusing the manifest entry's hash if size and mtime are unchanged"""
+    stat = os.stat(path)
+    if entry and entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+        return entry['sha256']
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def link_voice(src_file, dst_file):
+    """Place src_file at dst_file as a hardlink, falling back to a symlink and then a copy"""
+    if os.path.lexists(dst_file):
+        os.remove(dst_file)
+    try:
+        os.link(src_file, dst_file)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.abspath(src_file), dst_file)
+        return "symlink"
+    except OSError:
+        pass
+    shutil.copy2(src_file, dst_file)
+    return "copy"
+
+def sync_voices(src_dir, dst_dir, manifest=None):
+    """Link every source voice into the destination directory if it is missing or changed
+
+    Hashes are reused from the manifest of the destination directory while the
+    files' size and mtime are unchanged. Returns the hash, size and mtime of the
+    source files that had to be compared, keyed by voice name, to be recorded in
+    the next manifest.
+    """
+    old_voices = (manifest or {}).get('voices', {})
+    voice_files = sorted(f for f in os.listdir(src_dir) if f.endswith('.wav'))
+    print(f"Found {len(voice_files)} voice files: {', '.join(voice_files)}")
+
+    sources = {}
+    for voice_file in voice_files:
+        name = os.path.splitext(voice_file)[0]
+        src_file = os.path.join(src_dir, voice_file)
+        dst_file = os.path.join(dst_dir, voice_file)
+
+        if os.path.exists(dst_file):
+            if os.path.samefile(src_file, dst_file):
+                print(f"Voice file up to date: {dst_file}")
+                continue
+            entry = old_voices.get(name) or {}
+            src_sha256 = file_hash(src_file, entry.get('source'))
+            stat = os.stat(src_file)
+            sources[name] = {'sha256': src_sha256, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            if src_sha256 == file_hash(dst_file, entry):
+                print(f"Voice file up to date: {dst_file}")
+                continue
+
+        method = link_voice(src_file, dst_file)
+        print(f"Linked {src_file} to {dst_file} ({method})")
+
+    return sources
+
+def trim_silence(wav, sr):
+    """Trim leading and trailing silence from a mono waveform of shape (1, n)"""
+    frame = max(int(sr * SILENCE_FRAME_SECONDS), 1)
+    n_frames = wav.shape[-1] // frame
+    if n_frames == 0:
+        return wav
+    rms = wav[..., :n_frames * frame].reshape(n_frames, frame).pow(2).mean(dim=1).sqrt()
+    peak = rms.max()
+    if peak <= 0:
+        return wav
+    voiced = torch.nonzero(rms >= peak * 10 ** (SILENCE_THRESHOLD_DB / 20)).flatten()
+    pad = int(sr * SILENCE_PAD_SECONDS)
+    start = max(int(voiced[0]) * frame - pad, 0)
+    end = min((int(voiced[-1]) + 1) * frame + pad, wav.shape[-1])
+    return wav[..., start:end]
+
+def process_prompt(src_file, dst_file):
+    """Convert a voice clip to a mono, trimmed prompt at the model's native rate
+
+    Returns the duration of the processed prompt in seconds.
+    """
+    wav, sr = ta.load(src_file)
+    wav = wav.mean(dim=0, keepdim=True)
+    if sr != PROMPT_SAMPLE_RATE:
+        wav = ta.functional.resample(wav, sr, PROMPT_SAMPLE_RATE)
+    wav = trim_silence(wav, PROMPT_SAMPLE_RATE)
+    wav = wav[..., :PROMPT_MAX_SECONDS * PROMPT_SAMPLE_RATE]
+
+    # Write to a temporary file first so a crash never leaves a truncated prompt
+    tmp_file = dst_file + ".tmp.wav"
+    ta.save(tmp_file, wav, PROMPT_SAMPLE_RATE)
+    os.replace(tmp_file, dst_file)
+    return wav.shape[-1] / PROMPT_SAMPLE_RATE
+
+def build_manifest(voices_dir, sources=None):
+    """Pre-process the voices in voices_dir, re-processing only files whose content changed
+
+    sources, as returned by sync_voices, is recorded so the next sync can skip hashing.
+    """
+    sources = sources or {}
+    old_manifest = load_manifest(voices_dir) or {}
+    old_voices = old_manifest.get('voices', {})
+    rate_changed = old_manifest.get('sample_rate') != PROMPT_SAMPLE_RATE
+
+    prompts_dir = os.path.join(voices_dir, PROMPTS_DIR)
+    os.makedirs(prompts_dir, exist_ok=True)
+
+    voices = {}
+    for voice_file in sorted(f for f in os.listdir(voices_dir) if f.endswith('.wav')):
+        name = os.path.splitext(voice_file)[0]
+        voice_path = os.path.join(voices_dir, voice_file)
+        prompt_file = os.path.join(PROMPTS_DIR, voice_file)
+        prompt_path = os.path.join(voices_dir, prompt_file)
+        entry = old_voices.get(name)
+        sha256 = file_hash(voice_path, entry)
+
+        if (entry and not rate_changed and entry.get('sha256') == sha256
+                and os.path.exists(prompt_path)):
+            print(f"Voice prompt up to date: {prompt_file}")
+            duration = entry['duration']
+        else:
+            print(f"Processing voice prompt: {voice_file} -> {prompt_file}")
+            try:
+                duration = process_prompt(voice_path, prompt_path)
+            except Exception as e:
+                print(f"Warning: Could not process {voice_file}, using it unprocessed: {e}")
+                prompt_file = voice_file
+                duration = None
+
+        stat = os.stat(voice_path)
+        voices[name] = {
+            'file': voice_file,
+            'sha256': sha256,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'prompt': prompt_file,
+            'duration': duration,
+        }
+        if name in sources:
+            voices[name]['source'] = sources[name]
+
+    # Drop prompts of voices that no longer exist
+    for name, entry in old_voices.items():
+        stale_prompt = os.path.join(voices_dir, entry.get('prompt', ''))
+        if name not in voices and entry.get('prompt', '').startswith(PROMPTS_DIR) and os.path.exists(stale_prompt):
+            print(f"Removing stale voice prompt: {stale_prompt}")
+            os.remove(stale_prompt)
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'sample_rate': PROMPT_SAMPLE_RATE,
+        'voices': voices,
+    }
+    save_manifest(voices_dir, manifest)
+    return manifest
 
 def setup_voices():
     """Set up the voices directory for the HTTP server"""
     # Get the source and destination directories
     src_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "voices")
     dst_dir = os.path.join(os.path.dirname(__file__), "voices")
-    
+
     print(f"Source voices directory: {src_dir}")
     print(f"Destination voices directory: {dst_dir}")
-    
+
     # Create the destination directory if it doesn't exist
     if not os.path.exists(dst_dir):
         print(f"Creating destination directory: {dst_dir}")
         os.makedirs(dst_dir, exist_ok=True)
-    
-    # Check if the source directory exists
+
+    # In the Docker image the voices are mounted straight into the destination
+    sources = None
     if not os.path.exists(src_dir):
-        print(f"Source directory does not exist: {src_dir}")
-        return False
-    
-    # Copy the voice files
-    voice_files = [f for f in os.listdir(src_dir) if f.endswith('.wav')]
-    if not voice_files:
-        print("No voice files found in source directory")
+        print(f"Source directory does not exist: {src_dir}, using voices in {dst_dir}")
+    else:
+        sources = sync_voices(src_dir, dst_dir, load_manifest(dst_dir))
+
+    manifest = build_manifest(dst_dir, sources)
+    if not manifest['voices']:
+        print("No voice files found")
         return False
-    
-    print(f"Found {len(voice_files)} voice files: {', '.join(voice_files)}")
-    
-    # Copy each voice file
-    for voice_file in voice_files:
-        src_file = os.path.join(src_dir, voice_file)
-        dst_file = os.path.join(dst_dir, voice_file)
-        
-        if os.path.exists(dst_file):
-            print(f"Voice file already exists: {dst_file}")
-            continue
-        
-        print(f"Copying {src_file} to {dst_file}")
-        shutil.copy2(src_file, dst_file)
-    
-    # List the files in the destination directory
-    dst_files = [f for f in os.listdir(dst_dir) if f.endswith('.wav')]
-    print(f"Destination directory now contains {len(dst_files)} voice files: {', '.join(dst_files)}")
-    
+
+    print(f"Voice manifest now contains {len(manifest['voices'])} voices: {', '.join(manifest['voices'])}")
+
     return True
 
 if __name__ == "__main__":